@@ -1,9 +1,31 @@
+"""WiFi setup portal and connection manager for the Raspberry Pi Zero 2W.
+
+This module is the application's only entry point: run it directly (as
+wifi_manager.service does) so the connection manager and connectivity watcher start
+alongside the web server.
+"""
+
+import fcntl
 import logging
+import socket
+import struct
 import subprocess
 import time
 import os
+import re
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, replace
+from functools import lru_cache
 from flask import Flask, render_template, request, jsonify
-from threading import Thread, Lock, Event
+from jinja2 import FileSystemBytecodeCache
+from threading import Thread, Timer, Lock, Event, Condition
+from typing import Optional
+
+try:
+    from waitress import serve
+except ImportError:  # e.g. running under a system python3 without waitress installed
+    serve = None
 
 # Configure logging
 logging.basicConfig(
@@ -12,99 +34,391 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
+# Templates don't change at runtime; don't stat them on every render
+app.config["TEMPLATES_AUTO_RELOAD"] = False
+# Keep compiled templates on disk (in a per-user temp directory) across service
+# restarts; the temp directory is cleared at boot, so this doesn't help after a reboot.
+# Only an optimization, so carry on without it if the directory can't be used.
+try:
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache()
+except (OSError, RuntimeError):
+    logger.warning("Template bytecode cache unavailable", exc_info=True)
 
 AP_NAME = os.environ.get("AP_NAME", "piratos")
 AP_PASSWORD = os.environ.get("AP_PASSWORD", "raspberry")
-try:
-    CONNECTION_WAIT_TIME = int(os.environ.get("CONNECTION_WAIT_TIME", "10"))
-except ValueError:
-    logger.warning(
-        "Invalid CONNECTION_WAIT_TIME value %r; using default 10",
-        os.environ.get("CONNECTION_WAIT_TIME"),
-    )
-    CONNECTION_WAIT_TIME = 10
+
+
+def _env_int(name, default):
+    """Read an integer setting from the environment, falling back to `default`."""
+    raw = os.environ.get(name)
+    if raw is None:
+        return default
+    try:
+        return int(raw)
+    except ValueError:
+        logger.warning("Invalid %s value %r; using default %d", name, raw, default)
+        return default
+
+
+CONNECTION_WAIT_TIME = _env_int("CONNECTION_WAIT_TIME", 10)
 
 # Timing constants (configurable via environment variables / .env)
 # AP_DURATION: total time (in seconds) to keep the access point active before shutting it down.
 #              Default is 900 seconds (15 minutes) if AP_DURATION is not set in the environment.
-try:
-    AP_DURATION = int(os.environ.get("AP_DURATION", "900"))
-except ValueError:
-    logger.warning(
-        "Invalid AP_DURATION value %r; using default 900",
-        os.environ.get("AP_DURATION"),
-    )
-    AP_DURATION = 900
+AP_DURATION = _env_int("AP_DURATION", 900)
 # RECONNECT_WINDOW: time window (in seconds) to keep trying to connect to the target WiFi network
 #                   after credentials are submitted. Default is 120 seconds (2 minutes).
-try:
-    RECONNECT_WINDOW = int(os.environ.get("RECONNECT_WINDOW", "120"))
-except ValueError:
-    logger.warning(
-        "Invalid RECONNECT_WINDOW value %r; using default 120",
-        os.environ.get("RECONNECT_WINDOW"),
-    )
-    RECONNECT_WINDOW = 120
+RECONNECT_WINDOW = _env_int("RECONNECT_WINDOW", 120)
+
+# How long (in seconds) a WiFi scan result is reused before nmcli is queried again
+NETWORKS_CACHE_TTL = 20
+# Maximum time (in seconds) to wait for nmcli to list networks
+SCAN_TIMEOUT = 8
+# Maximum number of networks offered in the UI (nmcli lists the strongest first)
+MAX_NETWORKS = 50
+# How long (in seconds) a connectivity check result is shared between status polls
+CONNECTED_CACHE_TTL = 2.0
+# Upper bound on that age while watch_connectivity() is refreshing the cache on
+# NetworkManager events, in case a change produced no monitor line
+CONNECTED_CACHE_WATCHED_TTL = 30.0
+# Maximum time (in seconds) /check_status?wait=... holds a request waiting for a change
+STATUS_LONG_POLL_TIMEOUT = 10
+
+# Upper bound (in seconds) on any single nmcli call, so a wedged NetworkManager
+# can't block a thread forever. nmcli itself waits up to 90s for activations.
+NMCLI_TIMEOUT = 120
+
+# A WPA passphrase is 8-63 printable ASCII characters
+_PASSWORD_RE = re.compile(r"\A[\x20-\x7e]{8,63}\Z")
+
+# nmcli exit code for "connection, device or access point does not exist"
+NMCLI_NOT_FOUND = 10
+
+# No command is started with preexec_fn, shell=True or user/group switching, so
+# subprocess (CPython 3.10+) can spawn them with vfork() instead of fork() and skip
+# copying this process's page tables; keep it that way. nmcli and iwgetid are resolved
+# to absolute paths once here instead of being looked up in PATH on every spawn.
+NMCLI = shutil.which("nmcli") or "nmcli"
+IWGETID = shutil.which("iwgetid") or "iwgetid"
+
+# nmcli invocations used by start_ap(), built once since AP_NAME/AP_PASSWORD are fixed.
+# The hotspot profile is created with every setting in a single `con add`, so
+# NetworkManager only writes and reloads the connection once, then brought up.
+_AP_ADD_ARGV = (
+    NMCLI,
+    "con",
+    "add",
+    "con-name",
+    "hotspot",
+    "ifname",
+    "wlan0",
+    "type",
+    "wifi",
+    "ssid",
+    AP_NAME,
+    "wifi-sec.key-mgmt",
+    "wpa-psk",
+    "wifi-sec.psk",
+    AP_PASSWORD,
+    "802-11-wireless.mode",
+    "ap",
+    "802-11-wireless.band",
+    "bg",
+    "ipv4.method",
+    "shared",
+)
+_AP_UP_ARGV = (NMCLI, "con", "up", "hotspot", "ifname", "wlan0")
+_AP_START_STEPS = (
+    (_AP_ADD_ARGV, "add hotspot"),
+    (_AP_UP_ARGV, "bring up hotspot"),
+)
+# nmcli arguments listing nearby SSIDs: -g prints just the values and -e no leaves ':'
+# in SSIDs unescaped
+_SCAN_LIST_ARGS = ("-e", "no", "-g", "SSID", "dev", "wifi", "list")
+
+
+@dataclass(frozen=True)
+class ConnectionState:
+    """Snapshot of the manual connection attempt state.
+
+    Snapshots are immutable: writers build a new one under connection_state_lock and
+    rebind `connection_state`, so readers can use the current snapshot without locking.
+    """
+
+    in_progress: bool = False
+    ssid: Optional[str] = None
+    timestamp: Optional[float] = None
+    success: Optional[bool] = None
+    error: Optional[str] = None
+    manual_failure: bool = False  # Flag to indicate recent manual connection failure
+
 
 # Store connection attempt state
-connection_state = {
-    "in_progress": False,
-    "ssid": None,
-    "timestamp": None,
-    "success": None,
-    "error": None,
-    "manual_failure": False,  # Flag to indicate recent manual connection failure
-}
-connection_state_lock = Lock()
-connection_attempt_lock = Lock()  # Prevent concurrent connection attempts
-
-# Global event to signal the manager thread to wake up/check state
-manager_wake_event = Event()
+connection_state = ConnectionState()
+connection_state_lock = Lock()  # Serializes writers of connection_state
+
+# Incremented (and waiters notified) whenever anything reported by /check_status changes
+state_version = 0
+state_changed = Condition()
+# state_version restarts at 0 with the process, so ETags built from it also carry a
+# token picked once per process; otherwise a browser could revalidate a response
+# cached from a previous run against the same version and get a 304
+_ETAG_PREFIX = os.urandom(4).hex()
+
+# Single worker that runs manual connection attempts submitted from the web UI.
+# Together with the pending-future check in home() this keeps attempts one at a time.
+connect_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="wifi-connect")
+_connect_future = None  # Future of the most recently submitted connection attempt
+
+# Cached result of the last WiFi scan, see get_available_networks()
+_networks_cache = {"ts": None, "value": []}  # ts is None until the first scan
+_networks_cache_lock = Lock()
+_networks_scan_lock = Lock()  # Held while nmcli is scanning, so scans don't overlap
+
+# ioctl request number for reading an interface's IPv4 address (linux/sockios.h)
+SIOCGIFADDR = 0x8915
+
+# Cached result of the last connectivity check, see cached_is_connected()
+_connected_cache = {"ts": None, "value": False}  # ts is None until the first check
+_connected_cache_lock = Lock()
+# Set while watch_connectivity() is keeping _connected_cache up to date
+connectivity_watch_active = Event()
+_monitor_proc = None  # The running `nmcli monitor` process, if any
+
+# Set while a hotspot profile may exist, so stop_ap() can skip nmcli when none does.
+# Starts set because a previous run may have left a hotspot behind.
+hotspot_active = Event()
+hotspot_active.set()
+
+# Events that wake the manager thread. Each wait in connection_manager uses the one
+# event that can end it, so a set() never lands on an unrelated sleep and causes a
+# spurious cycle; shutdown sets both.
+user_action_event = Event()  # User submitted credentials (in_progress is now True)
+attempt_finished_event = Event()  # A manual connection attempt finished
 manager_stop_event = Event()
 
 
+def notify_state_changed():
+    """Bump state_version and wake any /check_status requests waiting for a change."""
+    global state_version
+    with state_changed:
+        state_version += 1
+        state_changed.notify_all()
+
+
+def update_connection_state(**changes):
+    """Publish a new connection_state snapshot with `changes` applied."""
+    global connection_state
+    with connection_state_lock:
+        connection_state = replace(connection_state, **changes)
+    notify_state_changed()
+
+
+def take_manual_failure():
+    """Return whether the last manual attempt failed, clearing the flag."""
+    global connection_state
+    with connection_state_lock:
+        failed = connection_state.manual_failure
+        if failed:
+            connection_state = replace(connection_state, manual_failure=False)
+    return failed
+
+
+def _read_file(path):
+    """Return the contents of a procfs/sysfs file, or None if it can't be read."""
+    try:
+        with open(path) as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def _iwgetid_associated():
+    """Fallback for _wifi_associated() when /proc/net/wireless is unavailable."""
+    try:
+        result = subprocess.run(
+            [IWGETID], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+    except OSError:
+        return False
+    return result.returncode == 0
+
+
+def _wifi_associated():
+    """Check whether wlan0 is associated with a network as a client.
+
+    The kernel only lists an interface in /proc/net/wireless while it is in station
+    mode with a current BSS, which is the same condition iwgetid reports on, but
+    without spawning a process. Running the hotspot does not count as connected.
+    """
+    wireless = _read_file("/proc/net/wireless")
+    if wireless is None:
+        # Kernels built without wireless extensions don't provide the file
+        return _iwgetid_associated()
+    return any(line.strip().startswith("wlan0:") for line in wireless.splitlines())
+
+
+def _ethernet_connected():
+    """Check whether eth0 is up and has an IPv4 address."""
+    operstate = _read_file("/sys/class/net/eth0/operstate")
+    if not operstate or operstate.strip() != "up":
+        return False
+
+    # Link is up; confirm that an IPv4 address has been assigned. Asking the kernel
+    # directly avoids spawning `ip addr` and parsing its output.
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            fcntl.ioctl(sock.fileno(), SIOCGIFADDR, struct.pack("256s", b"eth0"))
+    except OSError:
+        # EADDRNOTAVAIL when no IPv4 address is assigned
+        return False
+    return True
+
+
 def is_connected():
-    wifi_connected = subprocess.run(
-        ["iwgetid"], stdout=subprocess.PIPE, stderr=subprocess.PIPE
-    )
-    eth0_info = subprocess.run(
-        ["ip", "addr", "show", "eth0"],
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        text=True,
-    )
-    eth_connected = False
-    if eth0_info.returncode == 0:
-        output = eth0_info.stdout
-        # Check if interface is UP and has an inet (IPv4) address
-        if "state UP" in output and "inet " in output:
-            eth_connected = True
-    return wifi_connected.returncode == 0 or eth_connected
+    return _wifi_associated() or _ethernet_connected()
+
+
+def refresh_connected_cache(max_age=None):
+    """Run is_connected() and store the result for cached_is_connected().
+
+    With `max_age`, a result younger than that (stored by another poller while this
+    one waited for the lock) is returned instead of probing again.
+    """
+    with _connected_cache_lock:
+        if max_age is not None:
+            ts = _connected_cache["ts"]
+            if ts is not None and time.monotonic() - ts < max_age:
+                return _connected_cache["value"]
+        connected = is_connected()
+        changed = (
+            _connected_cache["ts"] is None or _connected_cache["value"] != connected
+        )
+        _connected_cache["ts"] = time.monotonic()
+        _connected_cache["value"] = connected
+    if changed:
+        notify_state_changed()
+    return connected
+
+
+def cached_is_connected():
+    """Return is_connected(), reusing a result younger than CONNECTED_CACHE_TTL.
+
+    While watch_connectivity() is running the cache is also refreshed on every
+    NetworkManager state change, so results are kept for up to
+    CONNECTED_CACHE_WATCHED_TTL instead; that still bounds how long a change the
+    monitor didn't report can go unnoticed. Otherwise the lock is held while checking,
+    so concurrent pollers wait for and share a single check instead of each running
+    their own.
+    """
+    if connectivity_watch_active.is_set():
+        max_age = CONNECTED_CACHE_WATCHED_TTL
+    else:
+        max_age = CONNECTED_CACHE_TTL
+    with _connected_cache_lock:
+        ts = _connected_cache["ts"]
+        if ts is not None and time.monotonic() - ts < max_age:
+            return _connected_cache["value"]
+    # Expired: pollers queue on the lock in refresh_connected_cache(), and all but the
+    # first find the result it just stored
+    return refresh_connected_cache(max_age=max_age)
+
+
+def watch_connectivity():
+    """Keep the connectivity cache current from `nmcli monitor` events.
+
+    NetworkManager prints a line for every device or connectivity state change, so
+    re-checking on each line keeps the cache accurate with far less polling. If the
+    monitor exits, cached_is_connected() falls back to its short TTL.
+    """
+    global _monitor_proc
+    try:
+        with subprocess.Popen(
+            [NMCLI, "monitor"],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+            bufsize=1,
+        ) as proc:
+            _monitor_proc = proc
+            # Refresh once the monitor is running. Changes before nmcli has subscribed
+            # to NetworkManager can still be missed; cached_is_connected() bounds the
+            # cache age to CONNECTED_CACHE_WATCHED_TTL for that.
+            refresh_connected_cache()
+            connectivity_watch_active.set()
+            for line in proc.stdout:
+                logger.debug("nmcli monitor: %s", line.strip())
+                refresh_connected_cache()
+    except OSError:
+        logger.exception("Failed to start nmcli monitor")
+    finally:
+        connectivity_watch_active.clear()
+        _monitor_proc = None
+    logger.warning("NetworkManager monitor exited; falling back to polling")
 
 
 def sanitize_output(output):
     """Redact sensitive information from subprocess output."""
-    if not output:
+    # Most output never contains AP_PASSWORD; the substring check avoids copying it.
+    # An empty AP_PASSWORD would "match" everywhere, so there is nothing to redact then.
+    if not output or not AP_PASSWORD or AP_PASSWORD not in output:
         return output
-    # Redact AP_PASSWORD if present
     return output.replace(AP_PASSWORD, "***REDACTED***")
 
 
-def log_subprocess_output(result):
-    """Log subprocess output, treating stdout as info and stderr as error only on failure."""
-    stdout_stripped = result.stdout.strip() if result.stdout else ""
-    stderr_stripped = result.stderr.strip() if result.stderr else ""
+def run_nmcli(*args, timeout=NMCLI_TIMEOUT, **kwargs):
+    """Run nmcli with the given arguments and return the CompletedProcess.
 
-    sanitized_stdout = sanitize_output(stdout_stripped)
-    sanitized_stderr = sanitize_output(stderr_stripped)
+    Output is text, and stdout/stderr are discarded (no pipes are allocated) unless
+    the caller passes stdout=/stderr=subprocess.PIPE for the stream it actually reads.
+    Raises subprocess.TimeoutExpired if nmcli runs longer than `timeout` seconds.
+    """
+    kwargs.setdefault("stdout", subprocess.DEVNULL)
+    kwargs.setdefault("stderr", subprocess.DEVNULL)
+    return subprocess.run([NMCLI, *args], timeout=timeout, text=True, **kwargs)
 
-    if sanitized_stdout:
-        logger.info(sanitized_stdout)
-    if sanitized_stderr:
-        if result.returncode != 0:
-            logger.error(sanitized_stderr)
-        else:
-            logger.info(sanitized_stderr)
+
+def run_logged(argv, timeout=NMCLI_TIMEOUT):
+    """Run a command, logging its combined stdout/stderr line by line as it is produced.
+
+    Returns (returncode, last_line), where last_line is the last non-empty line of
+    output (sanitized) so callers can include it in error messages. The command is
+    killed and subprocess.TimeoutExpired raised if it runs longer than `timeout`; the
+    exception only names the command and subcommand, since the full argv can carry
+    AP_PASSWORD and callers log the exception.
+    """
+    last_line = ""
+    with subprocess.Popen(
+        argv,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+        bufsize=1,
+    ) as proc:
+        # Reading blocks until the command exits, so enforce the timeout with a timer
+        timed_out = Event()
+
+        def kill():
+            timed_out.set()
+            proc.kill()
+
+        killer = Timer(timeout, kill)
+        killer.start()
+        # Only sanitize lines that will actually be logged
+        log_lines = logger.isEnabledFor(logging.INFO)
+        try:
+            for line in proc.stdout:
+                line = line.strip()
+                if line:
+                    if log_lines:
+                        logger.info("%s", sanitize_output(line))
+                    last_line = line
+            returncode = proc.wait()
+        finally:
+            killer.cancel()
+    if timed_out.is_set():
+        raise subprocess.TimeoutExpired(argv[:3], timeout)
+    return returncode, sanitize_output(last_line)
 
 
 def start_ap():
@@ -112,88 +426,17 @@ def start_ap():
         # First ensure no residual AP exists
         stop_ap()
 
-        out = subprocess.run(
-            [
-                "nmcli",
-                "con",
-                "add",
-                "con-name",
-                "hotspot",
-                "ifname",
-                "wlan0",
-                "type",
-                "wifi",
-                "ssid",
-                AP_NAME,
-            ],
-            capture_output=True,
-            text=True,
-        )
-        log_subprocess_output(out)
-        if out.returncode != 0:
-            raise RuntimeError(
-                f"Failed to add hotspot: {out.stderr.strip() or out.stdout.strip()}"
-            )
+        # Mark the hotspot as present before creating it, so a partially created
+        # profile is still cleaned up by stop_ap() if a later step fails
+        hotspot_active.set()
+        for argv, action in _AP_START_STEPS:
+            returncode, last_line = run_logged(argv)
+            if returncode != 0:
+                raise RuntimeError(f"Failed to {action}: {last_line}")
 
-        out = subprocess.run(
-            ["nmcli", "con", "modify", "hotspot", "wifi-sec.key-mgmt", "wpa-psk"],
-            capture_output=True,
-            text=True,
-        )
-        log_subprocess_output(out)
-        if out.returncode != 0:
-            raise RuntimeError(
-                f"Failed to set key management: {out.stderr.strip() or out.stdout.strip()}"
-            )
-
-        out = subprocess.run(
-            ["nmcli", "con", "modify", "hotspot", "wifi-sec.psk", AP_PASSWORD],
-            capture_output=True,
-            text=True,
-        )
-        log_subprocess_output(out)
-        if out.returncode != 0:
-            raise RuntimeError(
-                f"Failed to set hotspot password: {out.stderr.strip() or out.stdout.strip()}"
-            )
-
-        out = subprocess.run(
-            [
-                "nmcli",
-                "con",
-                "modify",
-                "hotspot",
-                "802-11-wireless.mode",
-                "ap",
-                "802-11-wireless.band",
-                "bg",
-                "ipv4.method",
-                "shared",
-            ],
-            capture_output=True,
-            text=True,
-        )
-        log_subprocess_output(out)
-        if out.returncode != 0:
-            raise RuntimeError(
-                f"Failed to set hotspot mode and band: {out.stderr.strip() or out.stdout.strip()}"
-            )
-
-        # Bring up the configured hotspot connection so the AP actually starts broadcasting
-        out = subprocess.run(
-            ["nmcli", "con", "up", "hotspot", "ifname", "wlan0"],
-            capture_output=True,
-            text=True,
-        )
-        log_subprocess_output(out)
-        if out.returncode != 0:
-            raise RuntimeError(
-                f"Failed to bring up hotspot: {out.stderr.strip() or out.stdout.strip()}"
-            )
-
-        logger.info(f"AP '{AP_NAME}' started successfully")
+        logger.info("AP '%s' started successfully", AP_NAME)
     except Exception as e:
-        logger.error(f"Failed to start AP: {e}")
+        logger.error("Failed to start AP: %s", e)
         # Try to clean up partially created connection
         stop_ap()
         raise
@@ -201,25 +444,92 @@ def start_ap():
 
 def stop_ap():
     """Stop the access point if it exists."""
-    result = subprocess.run(
-        ["nmcli", "-t", "-f", "NAME", "con", "show"], stdout=subprocess.PIPE, text=True
-    )
-
-    connection_names = [line.strip() for line in result.stdout.splitlines()]
-    if "hotspot" in connection_names:
-        logger.info("Stopping existing AP")
-        subprocess.run(["nmcli", "con", "down", "hotspot"], stderr=subprocess.DEVNULL)
-        subprocess.run(["nmcli", "con", "delete", "hotspot"], stderr=subprocess.DEVNULL)
-    else:
+    if not hotspot_active.is_set():
         logger.debug("No AP to stop")
+        return
 
+    # delete is safe to run when the hotspot is already gone, so skip the
+    # `nmcli con show` lookup and just issue it. Deleting an active profile also
+    # deactivates it, so a separate `con down` isn't needed.
+    logger.info("Stopping existing AP")
+    try:
+        result = run_nmcli("con", "delete", "hotspot")
+    except subprocess.TimeoutExpired:
+        logger.warning("Timed out stopping AP; will retry next time")
+        return
+    if result.returncode == NMCLI_NOT_FOUND:
+        logger.debug("Hotspot profile was already gone")
+    elif result.returncode != 0:
+        # Can't tell whether the hotspot was removed; keep the flag set and retry next time
+        logger.warning(
+            "Failed to delete hotspot (nmcli exit code %d)", result.returncode
+        )
+        return
+    hotspot_active.clear()
+
+
+def refresh_networks(rescan=False):
+    """Scan for nearby networks and store the SSIDs in the scan cache.
+
+    Only one scan runs at a time; a caller that waited for another scan to finish
+    reuses its result unless rescan=True, which forces NetworkManager to scan again.
+    """
+    with _networks_scan_lock:
+        if not rescan:
+            with _networks_cache_lock:
+                ts = _networks_cache["ts"]
+                if ts is not None and time.monotonic() - ts < NETWORKS_CACHE_TTL:
+                    return _networks_cache["value"]
+
+        # Unless asked to, reuse NetworkManager's last scan instead of scanning again,
+        # which would also briefly disrupt clients connected to the hotspot
+        try:
+            result = run_nmcli(
+                *_SCAN_LIST_ARGS,
+                "--rescan",
+                "yes" if rescan else "no",
+                stdout=subprocess.PIPE,
+                timeout=SCAN_TIMEOUT,
+            )
+        except subprocess.TimeoutExpired:
+            logger.warning("WiFi scan timed out after %d seconds", SCAN_TIMEOUT)
+            with _networks_cache_lock:
+                return _networks_cache["value"]
+        if result.returncode != 0:
+            # e.g. NetworkManager not running yet; keep the previous list (and its age)
+            # rather than caching an empty one as fresh
+            logger.warning("WiFi scan failed (nmcli exit code %d)", result.returncode)
+            with _networks_cache_lock:
+                return _networks_cache["value"]
+        # nmcli prints one line per access point, so SSIDs broadcast by several BSSIDs
+        # repeat; dict.fromkeys drops the duplicates while keeping scan order
+        networks = list(dict.fromkeys(net for net in result.stdout.splitlines() if net))
+        networks = networks[:MAX_NETWORKS]
+
+        with _networks_cache_lock:
+            _networks_cache["ts"] = time.monotonic()
+            _networks_cache["value"] = networks
+        return networks
+
+
+def get_available_networks(rescan=False):
+    """Return the SSIDs of nearby networks, reusing a recent scan when possible.
+
+    Scanning is slow and briefly disrupts the radio, so results are cached for
+    NETWORKS_CACHE_TTL seconds. Once that expires the stale list is still returned
+    immediately while a background thread refreshes it; only the very first call (or
+    rescan=True) waits for a scan.
+    """
+    with _networks_cache_lock:
+        ts = _networks_cache["ts"]
+        networks = _networks_cache["value"]
 
-def get_available_networks():
-    result = subprocess.run(
-        ["nmcli", "-t", "-f", "SSID", "dev", "wifi"], stdout=subprocess.PIPE
-    )
-    networks = result.stdout.decode().split("\n")
-    return [net for net in networks if net]
+    if rescan or ts is None:
+        return refresh_networks(rescan=rescan)
+    age = time.monotonic() - ts
+    if age >= NETWORKS_CACHE_TTL and not _networks_scan_lock.locked():
+        Thread(target=refresh_networks, daemon=True).start()
+    return networks
 
 
 def validate_network_input(ssid, password):
@@ -231,24 +541,17 @@ def validate_network_input(ssid, password):
     if len(ssid.encode("utf-8")) > 32:
         raise ValueError("SSID must be 32 bytes or fewer")
 
-    # Password validation for WPA/WPA2/WPA3-Personal: 8-63 ASCII characters
-    # Note: This follows the standard PSK (Pre-Shared Key) requirements
+    # Check for null bytes which could be used for injection
+    if "\0" in ssid:
+        raise ValueError("SSID cannot contain null bytes")
+
+    # Password validation for WPA/WPA2/WPA3-Personal: 8-63 printable ASCII characters
+    # Note: This follows the standard PSK (Pre-Shared Key) requirements, and also
+    # rules out null bytes
     if not password:
         raise ValueError("Password is required")
-
-    # Ensure password contains only ASCII characters (required for WPA PSK)
-    try:
-        password.encode("ascii")
-    except UnicodeEncodeError:
-        raise ValueError("Password must contain only ASCII characters")
-
-    # Validate length (ASCII characters are 1 byte each, so character count = byte count)
-    if len(password) < 8 or len(password) > 63:
-        raise ValueError("Password must be between 8 and 63 characters")
-
-    # Check for null bytes which could be used for injection
-    if "\0" in ssid or "\0" in password:
-        raise ValueError("SSID and password cannot contain null bytes")
+    if not _PASSWORD_RE.match(password):
+        raise ValueError("Password must be 8 to 63 printable ASCII characters")
 
     return True
 
@@ -256,17 +559,26 @@ def validate_network_input(ssid, password):
 def connect_to_network(ssid, password):
     """Connect to a WiFi network. Input validation should be done by caller.
 
-    Note: Password is passed as command line argument which may be visible in process lists.
-    This is a known limitation of using nmcli in this manner. For production use, consider
-    using nmcli's connection profile approach or stdin input for better security.
+    The password is answered to nmcli's `--ask` prompt over stdin rather than passed as
+    a command line argument, so it never shows up in process lists (/proc/<pid>/cmdline).
+
+    Returns (success, stderr). Only stderr is captured, since that is where nmcli
+    reports why a connection failed.
     """
     stop_ap()
-    result = subprocess.run(
-        ["nmcli", "dev", "wifi", "connect", ssid, "password", password],
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-    )
-    return result.returncode == 0, result.stdout.decode(), result.stderr.decode()
+    try:
+        result = run_nmcli(
+            "--ask",
+            "dev",
+            "wifi",
+            "connect",
+            ssid,
+            input=f"{password}\n",
+            stderr=subprocess.PIPE,
+        )
+    except subprocess.TimeoutExpired:
+        return False, f"Timed out after {NMCLI_TIMEOUT} seconds waiting for nmcli"
+    return result.returncode == 0, result.stderr
 
 
 def connection_manager():
@@ -288,20 +600,22 @@ def connection_manager():
     while not manager_stop_event.is_set():
         try:
             # 1. Check if user is actively trying to connect via UI
-            with connection_state_lock:
-                in_progress = connection_state["in_progress"]
-
-            if in_progress:
-                # User is attempting connection, don't interfere.
-                time.sleep(2)
+            if connection_state.in_progress:
+                # User is attempting connection, don't interfere until it finishes.
+                # The attempt has been noticed, so its user action is consumed too.
+                user_action_event.clear()
+                if attempt_finished_event.wait(timeout=30):
+                    attempt_finished_event.clear()
                 continue
 
-            # 2. Check current connection status
-            if is_connected():
+            # 2. Check current connection status live, since this decides whether
+            # the AP comes back. Right after a manual connection attempt this reuses
+            # the result its verification just stored (if younger than the short TTL).
+            if refresh_connected_cache(max_age=CONNECTED_CACHE_TTL):
                 logger.debug("Device is connected. Monitoring...")
                 # Sleep for 60s, but wakeable if user starts an action
-                manager_wake_event.wait(timeout=60)
-                manager_wake_event.clear()
+                if user_action_event.wait(timeout=60):
+                    user_action_event.clear()
                 continue
 
             # 3. Disconnected: Attempt Reconnect Phase
@@ -310,77 +624,92 @@ def connection_manager():
 
             # Check if this is due to a recent manual connection failure
             # If so, skip the reconnect window and go straight to AP mode
-            with connection_state_lock:
-                skip_reconnect = connection_state["manual_failure"]
-                if skip_reconnect:
-                    connection_state["manual_failure"] = False
-                    logger.info("Manual connection failed. Skipping reconnect window, starting AP immediately.")
+            skip_reconnect = take_manual_failure()
+            if skip_reconnect:
+                logger.info("Manual connection failed. Skipping reconnect window, starting AP immediately.")
 
             if not skip_reconnect:
                 # Trigger a rescan to help NetworkManager find networks
-                subprocess.run(["nmcli", "dev", "wifi", "rescan"], stderr=subprocess.DEVNULL)
+                try:
+                    run_nmcli("dev", "wifi", "rescan")
+                except subprocess.TimeoutExpired:
+                    logger.warning("Timed out requesting a WiFi rescan")
 
                 # Wait for reconnection (RECONNECT_WINDOW)
                 # Check frequently to see if we connected or if user took action
-                start_wait = time.time()
-                connected_during_wait = False
+                start_wait = time.monotonic()
+                restart_cycle = False
 
-                while time.time() - start_wait < RECONNECT_WINDOW:
+                while time.monotonic() - start_wait < RECONNECT_WINDOW:
                     if manager_stop_event.is_set():
                         return
 
-                    with connection_state_lock:
-                        if connection_state["in_progress"]:
-                            # User took action, break out of wait loop to top
-                            break
+                    if connection_state.in_progress:
+                        # User took action, break out of wait loop to top
+                        restart_cycle = True
+                        break
 
-                    if is_connected():
+                    if cached_is_connected():
                         logger.info("Reconnected successfully during wait window!")
-                        connected_during_wait = True
+                        restart_cycle = True
                         break
 
-                    time.sleep(5)
+                    # Sleep, but wake immediately on user action or shutdown
+                    if user_action_event.wait(5):
+                        user_action_event.clear()
 
-                if connected_during_wait:
+                # Reconnected or user action: loop back to top. A user action that
+                # woke the last wait just as the window ran out isn't seen inside the
+                # loop, so check in_progress once more.
+                if restart_cycle or connection_state.in_progress:
                     continue
 
-                # If we broke because of user action, loop back to top
-                with connection_state_lock:
-                    if connection_state["in_progress"]:
-                        continue
+            # Re-check live before deciding to bring the AP up
+            if refresh_connected_cache():
+                logger.info("Connection detected before starting AP.")
+                continue
 
             # 4. Reconnection Failed: AP Phase
-            logger.info(f"Reconnection failed. Starting AP for {AP_DURATION} seconds.")
+            if not skip_reconnect:
+                # While wlan0 is still in station mode, cache the list NetworkManager
+                # built from the rescan at the start of the window, so it is current
+                # for the first visitor to the portal. nmcli isn't asked to scan again,
+                # so this doesn't hold up the AP. (After a failed manual attempt the
+                # list the user picked from is still cached, and the AP must come back
+                # immediately, so this is skipped.)
+                refresh_networks()
+
+            logger.info("Reconnection failed. Starting AP for %d seconds.", AP_DURATION)
             try:
                 start_ap()
             except Exception:
                 logger.exception("Failed to start AP. Will retry cycle.")
-                time.sleep(30)
+                manager_stop_event.wait(30)
                 continue
 
             # Wait for AP_DURATION
             # Check frequently for user action or magical connection (e.g. ethernet)
-            start_ap_time = time.time()
-            while time.time() - start_ap_time < AP_DURATION:
+            start_ap_time = time.monotonic()
+            while time.monotonic() - start_ap_time < AP_DURATION:
                 if manager_stop_event.is_set():
                     stop_ap()
                     return
 
-                with connection_state_lock:
-                    if connection_state["in_progress"]:
-                        # User submitted WiFi credentials via UI. The connect_to_network function will stop the AP.
-                        # We exit this AP wait loop so the manager can proceed with the WiFi connection attempt.
-                        logger.info("User initiated connection. Exiting AP wait loop.")
-                        break
+                if connection_state.in_progress:
+                    # User submitted WiFi credentials via UI. The connect_to_network function will stop the AP.
+                    # We exit this AP wait loop so the manager can proceed with the WiFi connection attempt.
+                    logger.info("User initiated connection. Exiting AP wait loop.")
+                    break
 
                 # If ethernet is plugged in, we might be connected even with AP up
                 # (though unlikely to route correctly without bridge, but `is_connected` checks eth0)
-                if is_connected():
+                if cached_is_connected():
                     logger.info("Connection detected (possibly Ethernet). Stopping AP.")
                     stop_ap()
                     break
 
-                time.sleep(5)
+                if user_action_event.wait(5):
+                    user_action_event.clear()
 
             # 5. End of AP Phase
             # Loop will restart, which checks connection (likely false),
@@ -388,92 +717,141 @@ def connection_manager():
             logger.info("AP Phase ended. Cycling back to reconnection phase.")
         except Exception:
             logger.exception("Unexpected error in connection_manager loop. Will retry after 30s.")
-            time.sleep(30)
+            manager_stop_event.wait(30)
 
 
-def manual_connect_task(ssid, password):
-    """Task run by the web request thread to connect."""
+def wait_for_connection(timeout, interval=1):
+    """Poll is_connected() until it succeeds or `timeout` seconds have passed.
 
-    # Signal manager to wake up and see 'in_progress'
-    manager_wake_event.set()
+    Returns as soon as the connection is verified instead of always sleeping for the
+    full timeout, and gives up early if the application is shutting down. Each probe
+    goes through refresh_connected_cache(), so concurrent /check_status requests reuse
+    it rather than running their own checks.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        if refresh_connected_cache():
+            return True
+        remaining = deadline - time.monotonic()
+        if remaining <= 0 or manager_stop_event.wait(min(interval, remaining)):
+            return False
 
-    # Prevent concurrent connection attempts
-    if not connection_attempt_lock.acquire(blocking=False):
-        logger.warning("Connection attempt already in progress, ignoring new request")
-        # Update state so the UI can show an appropriate error for this request
-        with connection_state_lock:
-            connection_state["in_progress"] = False
-            connection_state["success"] = False
-            connection_state["error"] = "Another connection attempt is already in progress"
-            connection_state["timestamp"] = time.time()
-        return
+
+def manual_connect_task(ssid, password):
+    """Task run on connect_executor to connect to the submitted network."""
 
     try:
         # Update state
-        with connection_state_lock:
-            connection_state["in_progress"] = True
-            connection_state["ssid"] = ssid
-            connection_state["timestamp"] = time.time()
-            connection_state["success"] = None
-            connection_state["error"] = None
+        update_connection_state(
+            in_progress=True,
+            ssid=ssid,
+            timestamp=time.time(),
+            success=None,
+            error=None,
+        )
+        # Signal manager to wake up and see 'in_progress' (set only after the state
+        # is published, so the manager can't wake and miss it)
+        user_action_event.set()
 
         # Attempt connection
         # Note: connect_to_network handles stop_ap()
-        success, stdout, stderr = connect_to_network(ssid, password)
+        success, stderr = connect_to_network(ssid, password)
         last_error = stderr.strip() if not success else None
 
         if success:
-            # Wait for connection to stabilize
-            time.sleep(CONNECTION_WAIT_TIME)
-
-            # Verify connection
-            if is_connected():
-                logger.info(f"Successfully connected to {ssid}")
+            # Wait (up to CONNECTION_WAIT_TIME) for the connection to come up
+            if wait_for_connection(CONNECTION_WAIT_TIME):
+                logger.info("Successfully connected to %s", ssid)
             else:
                 success = False
                 last_error = "Connection established but verification failed"
         else:
-            logger.warning(f"Connection attempt failed: {last_error}")
+            logger.warning("Connection attempt failed: %s", last_error)
 
         # Update state based on final result
-        with connection_state_lock:
-            connection_state["in_progress"] = False
-            connection_state["success"] = success
-            connection_state["error"] = last_error
+        update_connection_state(
+            in_progress=False,
+            success=success,
+            error=last_error,
             # Set manual_failure flag so connection_manager skips reconnect window
-            connection_state["manual_failure"] = not success
+            manual_failure=not success,
+        )
 
         if not success:
             logger.info("Manual connection failed. Connection manager will restart AP immediately.")
 
+    except Exception:
+        # Nobody reads the executor's future, so log the error here, and always clear
+        # in_progress so the UI and the manager don't wait on this attempt forever
+        logger.exception("Unexpected error during manual connection attempt")
+        update_connection_state(
+            in_progress=False,
+            success=False,
+            error="Unexpected error while connecting",
+            manual_failure=True,
+        )
     finally:
-        connection_attempt_lock.release()
-        manager_wake_event.set()  # Wake manager to update status immediately
+        attempt_finished_event.set()  # Wake manager to act on the result immediately
 
 
 @app.route("/check_status")
 def check_status():
-    """Endpoint to check current connection status."""
-    with connection_state_lock:
-        conn_state = connection_state.copy()
+    """Endpoint to check current connection status.
+
+    With `?wait=<version>` (the version from a previous response) the request is held
+    for up to STATUS_LONG_POLL_TIMEOUT seconds until something changes, so clients can
+    re-request immediately instead of polling on a timer. Responses carry an ETag, and
+    a request whose If-None-Match still matches gets an empty 304.
+    """
+    seen_version = request.args.get("wait", type=int)
+    if seen_version is not None:
+        with state_changed:
+            state_changed.wait_for(
+                lambda: state_version != seen_version, timeout=STATUS_LONG_POLL_TIMEOUT
+            )
 
-    connected = is_connected()
+    # Read the version before the state so a change in between is reported next time
+    version = state_version
+    connected = cached_is_connected()
 
-    return jsonify(
-        {
-            "connected": connected,
-            "in_progress": conn_state["in_progress"],
-            "ssid": conn_state["ssid"],
-            "success": conn_state["success"],
-            "error": sanitize_output(conn_state["error"])
-            if conn_state["error"]
-            else None,
-        }
-    )
+    # Within this process every change to what is reported here bumps the version, so
+    # together with the per-process prefix it identifies the body
+    etag = f"{_ETAG_PREFIX}-{version}-{int(connected)}"
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        conn_state = connection_state  # Immutable snapshot; no lock needed
+        error = sanitize_output(conn_state.error) if conn_state.error else None
+        response = jsonify(
+            {
+                "version": version,
+                "connected": connected,
+                "in_progress": conn_state.in_progress,
+                "ssid": conn_state.ssid,
+                "success": conn_state.success,
+                "error": error,
+            }
+        )
+    response.set_etag(etag)
+    # Let browsers keep the response but revalidate it on every request
+    response.headers["Cache-Control"] = "no-cache"
+    return response
+
+
+@lru_cache(maxsize=8)
+def render_index(networks):
+    """Render index.html for a tuple of SSIDs.
+
+    The network list only changes when a new scan comes in, so the rendered page is
+    cached per list instead of re-running Jinja on every page load.
+    """
+    return render_template("index.html", networks=networks)
 
 
 @app.route("/", methods=["GET", "POST"])
 def home():
+    global _connect_future
+
     if request.method == "POST":
         ssid = request.form["network"]
         password = request.form["password"]
@@ -486,25 +864,82 @@ def home():
                 "status.html", status=f"Invalid input: {str(e)}", checking=False
             )
 
-        # Start background connection thread
-        thread = Thread(target=manual_connect_task, args=(ssid, password))
-        thread.start()
+        # Only one attempt can run at a time; reject submissions while one is pending.
+        # The future is the source of truth: in_progress left set by an attempt whose
+        # future has finished is stale and must not lock out new submissions.
+        with connection_state_lock:
+            state = connection_state
+            busy = _connect_future is not None and not _connect_future.done()
+            current_ssid = state.ssid if busy and state.in_progress else None
+            if not busy:
+                if state.in_progress:
+                    logger.warning(
+                        "Ignoring stale in-progress state from a finished attempt"
+                    )
+                # Run the connection attempt in the background
+                _connect_future = connect_executor.submit(
+                    manual_connect_task, ssid, password
+                )
+
+        if current_ssid is not None:
+            # Point the user at the attempt that is already running
+            return render_template(
+                "status.html",
+                status=f"Already connecting to {current_ssid}",
+                checking=True,
+            )
+        if busy:
+            return (
+                render_template(
+                    "status.html",
+                    status="Another connection attempt is already in progress",
+                    checking=False,
+                ),
+                429,
+            )
 
         # Return immediately with a status page that will poll for updates
         return render_template("status.html", status="Connecting...", checking=True)
 
-    networks = get_available_networks()
-    return render_template("index.html", networks=networks)
+    networks = get_available_networks(rescan=request.args.get("refresh") == "1")
+    return render_index(tuple(networks))
 
 
 if __name__ == "__main__":
     manager_thread = None
     try:
+        # Load and compile the templates up front so the first request doesn't pay for it
+        for template in ("index.html", "status.html"):
+            app.jinja_env.get_template(template)
+
+        # Warm the scan cache in the background so the first page load doesn't wait on nmcli
+        Thread(target=get_available_networks, daemon=True).start()
+
+        # Watch NetworkManager for state changes so status polls can use cached results.
+        # Daemon thread: it only blocks reading the monitor and holds no state to finish.
+        Thread(target=watch_connectivity, daemon=True).start()
+
         # Start the manager thread
         manager_thread = Thread(target=connection_manager, daemon=False)
         manager_thread.start()
 
-        app.run(host="0.0.0.0", port=8080)
+        if serve is not None:
+            # A small thread pool, so status polls don't queue behind each other or the form.
+            # Long-polled /check_status requests park a thread (idle, on a Condition) for
+            # up to STATUS_LONG_POLL_TIMEOUT, so leave room beyond a couple of open tabs.
+            serve(
+                app,
+                host="0.0.0.0",
+                port=8080,
+                threads=8,
+                connection_limit=32,
+                channel_timeout=15,
+            )
+        else:
+            logger.warning(
+                "waitress is not installed; using Flask's development server"
+            )
+            app.run(host="0.0.0.0", port=8080)
     except Exception:
         # Log any unexpected exceptions during startup or runtime
         logger.exception("Unhandled exception in main application loop")
@@ -513,6 +948,10 @@ if __name__ == "__main__":
         # Cleanup on shutdown
         logger.info("Shutting down...")
         manager_stop_event.set()
-        manager_wake_event.set()
+        user_action_event.set()
+        attempt_finished_event.set()
+        connect_executor.shutdown(wait=False, cancel_futures=True)
+        if _monitor_proc is not None:
+            _monitor_proc.terminate()
         # if manager_thread is not None:
         #     manager_thread.join()  # Optional: wait for it to stop